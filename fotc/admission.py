@@ -0,0 +1,274 @@
+# -*- encoding: utf-8 -*-
+
+import collections
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Text, Tuple
+
+import sqlalchemy as sqla
+from sqlalchemy.orm.session import Session as DbSession
+
+from fotc.catchup import record_presence_bulk
+from fotc.database import Session
+
+log = logging.getLogger("fotc")
+
+# priority classes, lower values are more important
+COMMAND = 0
+PRESENCE = 1
+WELCOME_BACK = 2
+
+PRIORITY_NAMES = {COMMAND: "command", PRESENCE: "presence", WELCOME_BACK: "welcome-back"}
+
+# fraction of a bucket's burst kept in reserve for more important work
+PRIORITY_RESERVE = {COMMAND: 0.0, PRESENCE: 0.2, WELCOME_BACK: 0.5}
+
+# seconds between sweeps dropping chat buckets that refilled completely
+BUCKET_EVICTION_INTERVAL = 60.0
+
+
+class TokenBucket(object):
+    """Token bucket refilled at `rate` tokens per second, holding at most `burst` tokens"""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self) -> float:
+        """Adds the tokens accrued since the last update, returning the tokens available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def can_take(self, reserve: float = 0.0) -> bool:
+        """Tells whether a token can be taken leaving at least `reserve` tokens afterwards"""
+        return self.refill() - 1 >= reserve
+
+    def take(self, reserve: float = 0.0) -> bool:
+        """Takes a token as long as at least `reserve` tokens are left afterwards"""
+        if not self.can_take(reserve):
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionController(object):
+    """
+    Decides whether an update is handled now, based on its priority and on current load
+
+    Every update goes through a per-chat and a global token bucket, where lower priority classes
+    cannot drain the tokens reserved for higher ones. When the update queue depth or the average
+    database transaction latency crosses its threshold, everything below COMMAND is shed. Chat
+    buckets that refilled completely are dropped, since a new bucket starts out full anyway.
+    """
+    def __init__(self, chat_rate: float, chat_burst: float, global_rate: float,
+                 global_burst: float, max_queue_depth: int, max_db_latency: float):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queue_depth = max_queue_depth
+        self.max_db_latency = max_db_latency
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.next_eviction = time.monotonic() + BUCKET_EVICTION_INTERVAL
+        self.queue_depth: Callable[[], int] = lambda: 0
+        self.db_latency = 0.0
+        self.db_latency_at = time.monotonic()
+        self.overloaded = False
+        self.admitted = collections.Counter()
+        self.shed: Dict[Tuple[int, Text], int] = collections.Counter()
+        self.lock = threading.Lock()
+
+    def admit(self, chat_id: int, priority: int) -> bool:
+        with self.lock:
+            if priority > COMMAND and self._is_overloaded():
+                self.shed[(priority, "overload")] += 1
+                return False
+
+            self._evict_idle_buckets()
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            # both buckets are checked before taking from either, so a refusal costs no tokens
+            if not bucket.can_take(PRIORITY_RESERVE[priority] * bucket.burst):
+                self.shed[(priority, "chat-rate")] += 1
+                return False
+            if not self.global_bucket.can_take(
+                    PRIORITY_RESERVE[priority] * self.global_bucket.burst):
+                self.shed[(priority, "global-rate")] += 1
+                return False
+            bucket.take()
+            self.global_bucket.take()
+
+            self.admitted[priority] += 1
+            return True
+
+    def allows(self, chat_id: int, priority: int) -> bool:
+        """
+        Tells whether optional work of `priority` may run for an update that was already admitted
+
+        No token is taken, the update paid for itself when admitted. The work is refused under
+        overload or once the chat or global bucket is down to the reserve of `priority`.
+        """
+        with self.lock:
+            if priority > COMMAND and self._is_overloaded():
+                self.shed[(priority, "overload")] += 1
+                return False
+
+            reserve = PRIORITY_RESERVE[priority]
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is not None and bucket.refill() < reserve * bucket.burst:
+                self.shed[(priority, "chat-rate")] += 1
+                return False
+            if self.global_bucket.refill() < reserve * self.global_bucket.burst:
+                self.shed[(priority, "global-rate")] += 1
+                return False
+
+            self.admitted[priority] += 1
+            return True
+
+    def track_db_latency(self, target):
+        """
+        Feeds record_db_latency from the statements executed by `target`, an Engine or its class
+
+        Statement time is summed per connection and recorded when the transaction ends, so time
+        a handler spends outside the database, e.g. talking to Telegram, is not counted.
+        """
+        sqla.event.listen(target, "before_cursor_execute", self._before_cursor_execute)
+        sqla.event.listen(target, "after_cursor_execute", self._after_cursor_execute)
+        sqla.event.listen(target, "commit", self._end_transaction)
+        sqla.event.listen(target, "rollback", self._end_transaction)
+
+    def record_db_latency(self, seconds: float):
+        """Feeds the exponentially weighted average of database transaction latency"""
+        with self.lock:
+            self.db_latency = 0.8 * self._current_db_latency() + 0.2 * seconds
+            self.db_latency_at = time.monotonic()
+
+    def summary(self) -> Text:
+        with self.lock:
+            latency_ms = self._current_db_latency() * 1000
+            lines = [f"Queue depth {self.queue_depth()}, DB latency {latency_ms:.0f}ms"
+                     f"{', overloaded' if self.overloaded else ''}"]
+            for priority, name in PRIORITY_NAMES.items():
+                shed = {reason: count for (p, reason), count in self.shed.items()
+                        if p == priority}
+                shed_s = ", ".join(f"{reason} {count}" for reason, count in sorted(shed.items()))
+                lines.append(f"{name}: admitted {self.admitted[priority]}, "
+                             f"shed {sum(shed.values())}" + (f" ({shed_s})" if shed_s else ""))
+            return "\n".join(lines)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info["fotc_statement_started"] = time.monotonic()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("fotc_statement_started", None)
+        if started is not None:
+            elapsed = time.monotonic() - started
+            conn.info["fotc_db_time"] = conn.info.get("fotc_db_time", 0.0) + elapsed
+
+    def _end_transaction(self, conn):
+        db_time = conn.info.pop("fotc_db_time", None)
+        if db_time is not None:
+            self.record_db_latency(db_time)
+
+    def _evict_idle_buckets(self):
+        now = time.monotonic()
+        if now < self.next_eviction:
+            return
+        self.next_eviction = now + BUCKET_EVICTION_INTERVAL
+        idle = [chat_id for chat_id, bucket in self.chat_buckets.items()
+                if bucket.refill() >= bucket.burst]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+
+    def _current_db_latency(self) -> float:
+        # decays while no transactions run, so shedding cannot keep latency stale forever
+        idle = time.monotonic() - self.db_latency_at
+        return self.db_latency * 0.5 ** (idle / 10.0)
+
+    def _is_overloaded(self) -> bool:
+        queue_depth = self.queue_depth()
+        db_latency = self._current_db_latency()
+        overloaded = queue_depth > self.max_queue_depth or db_latency > self.max_db_latency
+        if overloaded != self.overloaded:
+            log.warning("Admission control %s load shedding (queue depth %s, DB latency %.3fs)",
+                        "started" if overloaded else "stopped", queue_depth, db_latency)
+            self.overloaded = overloaded
+        return overloaded
+
+
+class DeferredPresence(object):
+    """
+    Folds presence updates that were not admitted into one bulk write per (user, group)
+
+    The background flush thread is started on the first deferred update.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pending: Dict[Tuple[int, int], datetime] = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._flush_loop, name="DeferredPresence",
+                                       daemon=True)
+        self.stop_event = threading.Event()
+
+    def defer(self, user_id: int, chat_id: int):
+        with self.lock:
+            self.pending[(user_id, chat_id)] = datetime.utcnow()
+            if not self.thread.is_alive() and not self.stop_event.is_set():
+                self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=10)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        session: DbSession = Session()
+        try:
+            record_presence_bulk(session, pending)
+            session.commit()
+        except Exception:
+            session.rollback()
+            log.exception("Failed to flush %s deferred presence updates", len(pending))
+        finally:
+            session.close()
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+
+
+def get_default_controller() -> AdmissionController:
+    """
+    Creates an admission controller from environment variables
+
+    Environment variables:
+        FOTC_CHAT_RATE, FOTC_CHAT_BURST: per-chat updates per second and burst size
+        FOTC_GLOBAL_RATE, FOTC_GLOBAL_BURST: updates per second and burst size for the whole bot,
+            split evenly between the FOTC_WORKER_PROCESSES processes since each has its own bucket
+        FOTC_MAX_QUEUE_DEPTH: pending updates above which low priority work is shed
+        FOTC_MAX_DB_LATENCY: average seconds of database work per transaction above which low
+            priority work is shed
+    """
+    env = os.environ.get
+    processes = max(1, int(env("FOTC_WORKER_PROCESSES", 1)))
+    return AdmissionController(chat_rate=float(env("FOTC_CHAT_RATE", 2)),
+                               chat_burst=float(env("FOTC_CHAT_BURST", 20)),
+                               global_rate=float(env("FOTC_GLOBAL_RATE", 30)) / processes,
+                               global_burst=float(env("FOTC_GLOBAL_BURST", 200)) / processes,
+                               max_queue_depth=int(env("FOTC_MAX_QUEUE_DEPTH", 100)),
+                               max_db_latency=float(env("FOTC_MAX_DB_LATENCY", 0.5)))
+
+
+admission = get_default_controller()
+deferred_presence = DeferredPresence(interval=float(os.environ.get("FOTC_PRESENCE_FLUSH", 5)))
@@ -0,0 +1,79 @@
+# -*- encoding: utf-8 -*-
+
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import pytz
+
+
+class WarmCache(object):
+    """
+    Process-wide cache of database state that is expensive to rediscover after a restart
+
+    Holds the ids of groups and memberships known to be persisted and the schedule of pending
+    reminders (id => scheduled time as naive UTC). Entries are only added once they have been
+    read back from the database, so the cache never claims a row exists before its transaction
+    has committed. Users are not cached: every caller reads their last_active or timezone, which
+    loads the row anyway.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.groups: Set[int] = set()
+        self.memberships: Dict[Tuple[int, int], int] = {}
+        self.reminders: Dict[int, datetime] = {}
+        self.last_reminder_id = 0
+        self.reminders_warm = False
+
+    def add_group(self, group_id: int):
+        with self.lock:
+            self.groups.add(group_id)
+
+    def has_group(self, group_id: int) -> bool:
+        with self.lock:
+            return group_id in self.groups
+
+    def add_membership(self, user_id: int, group_id: int, group_user_id: int):
+        with self.lock:
+            self.memberships[(user_id, group_id)] = group_user_id
+
+    def membership_id(self, user_id: int, group_id: int) -> Optional[int]:
+        with self.lock:
+            return self.memberships.get((user_id, group_id))
+
+    def add_reminder(self, reminder_id: int, scheduled_for: datetime):
+        with self.lock:
+            self.reminders[reminder_id] = _to_utc_naive(scheduled_for)
+            self.last_reminder_id = max(self.last_reminder_id, reminder_id)
+
+    def remove_reminders(self, reminder_ids: Iterable[int]):
+        with self.lock:
+            for reminder_id in reminder_ids:
+                self.reminders.pop(reminder_id, None)
+
+    def replace_reminders(self, reminders: Dict[int, datetime]):
+        with self.lock:
+            self.reminders = {k: _to_utc_naive(v) for k, v in reminders.items()}
+            self.last_reminder_id = max(self.last_reminder_id, max(self.reminders, default=0))
+            self.reminders_warm = True
+
+    def due_reminders(self, now: datetime) -> List[int]:
+        with self.lock:
+            return [k for k, when in self.reminders.items() if when <= now]
+
+    def clear(self):
+        with self.lock:
+            self.groups.clear()
+            self.memberships.clear()
+            self.reminders.clear()
+            self.last_reminder_id = 0
+            self.reminders_warm = False
+
+
+def _to_utc_naive(when: datetime) -> datetime:
+    if when.tzinfo is None:
+        return when
+    return when.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+warm_cache = WarmCache()
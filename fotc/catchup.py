@@ -0,0 +1,142 @@
+# -*- encoding: utf-8 -*-
+
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+import telegram
+from sqlalchemy.orm.session import Session as DbSession
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher
+
+from fotc.database import Session
+from fotc.repository import ChatUserRepository, ChatGroupRepository, after_commit
+from fotc.roster import roster_index
+
+log = logging.getLogger("fotc")
+
+
+class BacklogCatchUp(object):
+    """
+    Drains the pending update backlog left behind by a restart or outage before regular polling
+
+    Presence-only messages are folded into a single last-activity timestamp per (user, group)
+    and written in one transaction, commands older than `max_age` are dropped, and every other
+    update is handed to the dispatcher as usual.
+    """
+    def __init__(self, bot: telegram.Bot, dispatcher: Dispatcher, threshold: int,
+                 max_age: timedelta):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.threshold = threshold
+        self.max_age = max_age
+        self.presence: Dict[Tuple[int, int], datetime] = {}
+        self.processed = 0
+        self.folded = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.elapsed = 0.0
+
+    def should_run(self) -> bool:
+        try:
+            info = self.bot.get_webhook_info()
+        except TelegramError:
+            log.exception("Unable to fetch pending update count, skipping backlog catch-up")
+            return False
+        if info.url:
+            log.info("Webhook is set, skipping backlog catch-up")
+            return False
+        log.info("%s pending updates, catch-up threshold is %s", info.pending_update_count,
+                 self.threshold)
+        return info.pending_update_count > self.threshold
+
+    def run(self) -> Optional[int]:
+        """
+        Processes and acknowledges all pending updates, returning the next update offset
+
+        Returns None when there was nothing to process. If fetching updates fails midway, the
+        presence folded so far is still written and the offset past the last processed update
+        is returned, so regular polling resumes without running any command twice.
+        """
+        started = time.monotonic()
+        offset = None
+        try:
+            while True:
+                updates = self.bot.get_updates(offset, limit=100, timeout=0)
+                if not updates:
+                    break
+                for update in updates:
+                    self._process_update(update)
+                    offset = update.update_id + 1
+        except Exception: # fall back to regular polling with whatever was processed
+            log.exception("Backlog catch-up interrupted after %s updates", self.processed)
+
+        self._write_presence()
+        self.elapsed = time.monotonic() - started
+        return offset
+
+    def summary(self) -> str:
+        return (f"Caught up on {self.processed} updates in {self.elapsed:.1f}s: "
+                f"{self.folded} presence updates folded into {len(self.presence)} writes, "
+                f"{self.dispatched} dispatched, {self.dropped} stale commands dropped")
+
+    def _process_update(self, update: telegram.Update):
+        self.processed += 1
+        message = update.message
+        if not message or not message.text or not update.effective_user:
+            self._dispatch(update)
+            return
+
+        if message.text.startswith('/'):
+            if datetime.now() - message.date <= self.max_age:
+                self._dispatch(update)
+                return
+            self.dropped += 1
+        else:
+            self.folded += 1
+
+        # from_timestamp yields naive local time, last_active is stored as naive UTC
+        sent_on = datetime.utcfromtimestamp(message.date.timestamp())
+        key = (update.effective_user.id, update.effective_chat.id)
+        if key not in self.presence or self.presence[key] < sent_on:
+            self.presence[key] = sent_on
+
+    def _dispatch(self, update: telegram.Update):
+        self.dispatched += 1
+        self.dispatcher.process_update(update)
+
+    def _write_presence(self):
+        if not self.presence:
+            return
+        session: DbSession = Session()
+        try:
+            record_presence_bulk(session, self.presence)
+            session.commit()
+        except Exception:
+            session.rollback()
+            log.exception("Failed to write folded presence for %s memberships",
+                          len(self.presence))
+
+
+def record_presence_bulk(session: DbSession, presence: Dict[Tuple[int, int], datetime]):
+    """Bulk version of main._record_presence, without triggering activity callbacks"""
+    user_repo = ChatUserRepository(session)
+    group_repo = ChatGroupRepository(session)
+
+    users = user_repo.find_or_create_many(user_id for user_id, _ in presence)
+    group_repo.find_or_create_many(group_id for _, group_id in presence)
+    group_repo.record_memberships(presence.keys())
+
+    for (user_id, _), last_active in presence.items():
+        user = users[user_id]
+        if user.last_active is None or user.last_active < last_active:
+            user.last_active = last_active
+
+    members = [(group_id, user_id, users[user_id].timezone) for user_id, group_id in presence]
+
+    def index_members():
+        for member in members:
+            roster_index.add_member(*member)
+    after_commit(session, index_members)
+
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import logging
+
 import telegram
 from telegram.ext import CommandHandler
+from fotc.admission import admission, COMMAND
 from fotc.database import Session
 
+log = logging.getLogger("fotc")
+
 
 class DbCommandHandler(CommandHandler):
     """
@@ -18,6 +23,9 @@ class DbCommandHandler(CommandHandler):
 
     def _callback_wrapper(self, bot: telegram.Bot, update: telegram.Update, **kwargs):
         """Begins a database transaction and forwards command arguments to the inner callback"""
+        if not admission.admit(update.effective_chat.id, COMMAND):
+            log.info("Command from chat %s shed by admission control", update.effective_chat.id)
+            return
         try:
             session = Session()
             self.inner_callback(session, bot, update, **kwargs)
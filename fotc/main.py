@@ -1,13 +1,17 @@
 #!/usr/bin/env python3.6
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
+import html
 import io
 import logging
+import math
+import multiprocessing
 import os
 import random
 import signal
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError
-from typing import Text
+from typing import Optional, Text
 
 import dateparser
 import pytz
@@ -16,20 +20,30 @@ import requests
 import telegram
 from sqlalchemy.orm.session import Session as DbSession
 from telegram.error import BadRequest
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters
 
 from fotc.database import Session as SessionMaker
 from fotc.database import Reminder, ChatUser, GroupUser
 from fotc.repository import ChatUserRepository, ChatGroupRepository, ReminderRepository, \
-    QuoteRepository
+    QuoteRepository, after_commit
 from fotc.handlers import DbCommandHandler
+from fotc.admission import admission, deferred_presence, PRESENCE, WELCOME_BACK
+from fotc.cache import warm_cache
+from fotc.catchup import BacklogCatchUp
 from fotc.poller import RemindersPoller
+from fotc.profiler import SamplingProfiler, ProfileResult, write_report
+from fotc.roster import roster_index, timezone_cache
+from fotc.sharding import ShardSupervisor
+from fotc.snapshot import SnapshotError, get_snapshot_path, load_snapshot, verify_snapshot_async, \
+    write_snapshot
 from fotc.util import parse_command_args, memegen_str
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 log = logging.getLogger("fotc")
 
+profiler = SamplingProfiler()
+
 
 def greet_handler(db_session: DbSession, bot: telegram.Bot, update: telegram.Update):
     """
@@ -146,6 +160,7 @@ def set_timezone_handler(db_session: DbSession, bot: telegram.Bot, update: teleg
     user_id = update.effective_user.id
     log.info("Updating timezone setting for %s: %s", user_id, tz_string)
     user.timezone =  tz_string
+    after_commit(db_session, lambda: roster_index.set_timezone(user_id, tz_string))
     update.message.reply_text(f"Timezone updated to {tz_string}", quote=True)
 
 
@@ -183,6 +198,11 @@ def lenny_handler(db_session: DbSession, bot: telegram.Bot, update: telegram.Upd
 
 def group_membership_handler(bot: telegram.Bot, update: telegram.Update):
     """Stream of all messages the bot can see"""
+    if not admission.admit(update.effective_chat.id, PRESENCE):
+        if update.effective_user:
+            deferred_presence.defer(update.effective_user.id, update.effective_chat.id)
+        return
+
     #TODO: refactor this
     session = SessionMaker()
     try:
@@ -198,14 +218,16 @@ def group_time_handler(db_session: DbSession, bot: telegram.Bot, update: telegra
 
     chat_id = update.effective_chat.id
     group_repo = ChatGroupRepository(db_session)
-    members = group_repo.list_group_members(group)
-    members_with_tz = filter(lambda u: u.timezone is not None, members)
+    group_repo.load_roster(group)
+    now = datetime.utcnow()
     entries = []
-    for utz in members_with_tz:
-        user = bot.get_chat_member(chat_id, utz.id).user
-        user_mention = f"<pre>{user.first_name}</pre>"
-        timezone = pytz.timezone(utz.timezone)
-        localtime = pytz.utc.localize(datetime.utcnow()).astimezone(timezone)
+    for member in roster_index.members_with_timezone(group.id):
+        name = member.name
+        if not name:
+            name = bot.get_chat_member(chat_id, member.user_id).user.first_name
+            roster_index.set_name(member.user_id, name)
+        user_mention = f"<pre>{name}</pre>"
+        localtime = timezone_cache.localtime(member.timezone, now)
         time_s = localtime.strftime("%H:%M:%S")
         extra_s = localtime.strftime("%Y-%m-%d %Z%z")
         entries.append(f"{user_mention} <b>{time_s}</b> <i>{extra_s}</i>")
@@ -278,6 +300,9 @@ def _record_presence(session: DbSession, bot: telegram.Bot, update: telegram.Upd
     user = user_repo.find_or_create_by_id(update.effective_user.id)
     group = group_repo.find_or_create_by_id(update.effective_chat.id)
     group_user = group_repo.record_membership(group, user)
+    # values are bound now, reading them after commit would reload the expired rows
+    member = (group.id, user.id, user.timezone, update.effective_user.first_name)
+    after_commit(session, lambda: roster_index.add_member(*member))
 
     now = datetime.utcnow()
     prev_activity = user.last_active if user.last_active else now
@@ -290,6 +315,8 @@ def _on_user_activity(session: DbSession, bot: telegram.Bot, update: telegram.Up
                       user: ChatUser,  group_user: GroupUser, last_active: datetime):
     dt = user.last_active - last_active
     if dt > timedelta(hours=12):
+        if not admission.allows(group_user.group_id, WELCOME_BACK):
+            return
         #TODO: make dt configurable
         log.info("%s has become active after %s seconds idle", user.id, dt.total_seconds())
         quote_repo = QuoteRepository(session)
@@ -305,9 +332,40 @@ def _on_user_activity(session: DbSession, bot: telegram.Bot, update: telegram.Up
         quote.last_sent_on = datetime.utcnow()
 
 
-def _register_command_handlers(updater: Updater):
+def profile_handler(bot: telegram.Bot, update: telegram.Update):
+    """Starts a sampling profiler run, restricted to the admin chat"""
+    if not _is_admin_chat(update.effective_chat.id):
+        log.info("Ignoring /profile issued from non-admin chat %s", update.effective_chat.id)
+        return
+
+    parsed = parse_command_args(update.message.text)
+    args = parsed[1] if parsed else []
+    try:
+        duration = float(args[0]) if args else _default_profile_duration()
+        if not math.isfinite(duration):
+            raise ValueError(f"non-finite duration {duration}")
+    except ValueError:
+        update.message.reply_text("Duration must be a number of seconds", quote=True)
+        return
+
+    _start_profiling(bot, duration)
+
+
+def admission_handler(bot: telegram.Bot, update: telegram.Update):
+    """Replies with admission control state and shed counts, restricted to the admin chat"""
+    if not _is_admin_chat(update.effective_chat.id):
+        log.info("Ignoring /admission issued from non-admin chat %s", update.effective_chat.id)
+        return
+    update.message.reply_text(admission.summary(), quote=True)
+
+
+def _register_command_handlers(dispatcher: Dispatcher):
     """Registers all exposed Telegram command handlers"""
-    updater.dispatcher.add_handler(MessageHandler(Filters.text, group_membership_handler))
+    admission.queue_depth = dispatcher.update_queue.qsize
+    admission.track_db_latency(Engine)
+    dispatcher.add_handler(MessageHandler(Filters.text, group_membership_handler))
+    dispatcher.add_handler(CommandHandler("profile", profile_handler))
+    dispatcher.add_handler(CommandHandler("admission", admission_handler))
 
     persistent = {
         "greet": greet_handler,
@@ -322,7 +380,7 @@ def _register_command_handlers(updater: Updater):
         "rmquote": remove_quote_handler,
     }
     for k, v in persistent.items():
-        updater.dispatcher.add_handler(DbCommandHandler(k, v))
+        dispatcher.add_handler(DbCommandHandler(k, v))
 
 
 def _send_message_admin(bot: telegram.Bot, text: Text, **kwargs):
@@ -333,24 +391,190 @@ def _send_message_admin(bot: telegram.Bot, text: Text, **kwargs):
         bot.send_message(chat_id, text, **kwargs)
 
 
-def _handle_sigterm(bot: telegram.Bot, poller: RemindersPoller, sig):
+def _send_document_admin(bot: telegram.Bot, path: Text, **kwargs) -> bool:
+    chat_id = os.environ.get("TELEGRAM_ADMIN_CHATID", None)
+    if not chat_id:
+        log.warning("No admin chatId defined, would send document: \"%s\"", path)
+        return False
+    with open(path, "rb") as document:
+        bot.send_document(chat_id, document, **kwargs)
+    return True
+
+
+def _is_admin_chat(chat_id: int) -> bool:
+    admin_chat_id = os.environ.get("TELEGRAM_ADMIN_CHATID", None)
+    return bool(admin_chat_id) and str(chat_id) == admin_chat_id
+
+
+def _default_profile_duration() -> float:
+    return float(os.environ.get("FOTC_PROFILE_SECONDS", 30))
+
+
+def _start_profiling(bot: telegram.Bot, duration: float):
+    max_duration = float(os.environ.get("FOTC_PROFILE_MAX_SECONDS", 300))
+    duration = min(max(duration, 1.0), max_duration)
+    if not profiler.start(duration, lambda result: _on_profile_done(bot, result)):
+        _send_message_admin(bot, "A profiling run is already in progress")
+        return
+    log.info("Started sampling profiler for %s seconds", duration)
+    _send_message_admin(bot, f"Profiling for {duration:.0f} seconds")
+
+
+def _on_profile_done(bot: telegram.Bot, result: ProfileResult):
+    path = write_report(result, os.environ.get("FOTC_PROFILE_DIR", None))
+    log.info("Profile written to %s", path)
+    _send_message_admin(bot, f"<pre>{html.escape(result.summary())}</pre>",
+                        parse_mode=telegram.ParseMode.HTML)
+    # the report is only kept on disk when it could not be delivered
+    if _send_document_admin(bot, path, caption="Collapsed stacks, render with flamegraph.pl"):
+        os.remove(path)
+
+
+def _handle_sigusr1(bot: telegram.Bot, sig):
+    log.info("Received signal %s, starting profiler", sig)
+    _start_profiling(bot, _default_profile_duration())
+
+
+def _stop_dispatching():
+    """Stops profiling, flushes deferred presence and logs the admission counters of this process"""
+    profiler.stop()
+    deferred_presence.stop()
+    log.info(admission.summary())
+
+
+def _handle_sigterm(bot: telegram.Bot, poller: RemindersPoller, sig, dispatching: bool = True):
     if sig in [signal.SIGTERM, signal.SIGINT]:
         sig_msg = f"Shutting down on signal {sig}"
         log.info(sig_msg)
         poller.stop()
+        if dispatching:
+            _stop_dispatching()
+        _save_warm_cache()
         _send_message_admin(bot, sig_msg)
     else:
         log.info("Ignoring received signal %s", sig)
 
 
+def _save_warm_cache(process_name: Optional[Text] = None):
+    path = get_snapshot_path(process_name)
+    if not path:
+        return
+    try:
+        write_snapshot(warm_cache, path)
+        log.info("Wrote warm-start snapshot to %s", path)
+    except OSError:
+        log.exception("Failed to write warm-start snapshot to %s", path)
+
+
+def _load_warm_cache(process_name: Optional[Text] = None):
+    """Warms caches from the last shutdown snapshot, verifying it in the background"""
+    path = get_snapshot_path(process_name)
+    if not path:
+        log.info("FOTC_SNAPSHOT_PATH undefined, starting with cold caches")
+        return
+    try:
+        if load_snapshot(warm_cache, path):
+            verify_snapshot_async(warm_cache)
+    except (OSError, SnapshotError):
+        log.exception("Failed to load warm-start snapshot from %s, starting cold", path)
+        warm_cache.clear()
+
+
+def _create_catch_up(bot: telegram.Bot, dispatcher: Optional[Dispatcher]) -> BacklogCatchUp:
+    threshold = int(os.environ.get("FOTC_CATCHUP_THRESHOLD", 200))
+    max_age = timedelta(seconds=float(os.environ.get("FOTC_CATCHUP_MAX_AGE", 300)))
+    return BacklogCatchUp(bot, dispatcher, threshold, max_age)
+
+
+def _create_reminders_poller(bot: telegram.Bot) -> RemindersPoller:
+    """
+    Creates the reminders poller from environment variables
+
+    Environment variables:
+        FOTC_REMINDER_RECONCILE: seconds between full rebuilds of the reminder schedule. A
+            reminder whose id commits below the newest scheduled id is only picked up by the next
+            rebuild, so it may be sent up to this many seconds late
+    """
+    reconcile_interval = float(os.environ.get("FOTC_REMINDER_RECONCILE", 60))
+    return RemindersPoller(bot, interval=1, reconcile_interval=reconcile_interval)
+
+
+def _catch_up_backlog(updater: Updater):
+    """Drains a large pending update backlog in catch-up mode before regular polling starts"""
+    catch_up = _create_catch_up(updater.bot, updater.dispatcher)
+    if not catch_up.should_run():
+        return
+
+    next_offset = catch_up.run()
+    if next_offset is not None:
+        updater.last_update_id = next_offset
+    log.info(catch_up.summary())
+    _send_message_admin(updater.bot, catch_up.summary())
+
+
+def _setup_worker(dispatcher: Dispatcher):
+    """
+    Configures a shard worker process, which profiles itself on SIGUSR1
+
+    Workers keep their own warm-start snapshot, named after the worker. Replacements reuse the
+    name of the worker they replace, so they start with the caches of the chats they take over.
+    """
+    name = multiprocessing.current_process().name
+    _load_warm_cache(name)
+    _register_command_handlers(dispatcher)
+    signal.signal(signal.SIGUSR1, lambda sig, _: _handle_sigusr1(dispatcher.bot, sig))
+
+    def teardown():
+        _stop_dispatching()
+        _save_warm_cache(name)
+    return teardown
+
+
+def _main_sharded(token: Text, processes: int):
+    """
+    Runs a supervisor that shards updates by chat across `processes` worker processes
+
+    SIGUSR1 is forwarded to the workers, each sending its own profile. Backlog catch-up is not
+    supported in this mode, a large backlog is drained by regular polling.
+    """
+    bot = telegram.Bot(token)
+    _load_warm_cache()
+    poller = _create_reminders_poller(bot)
+    supervisor = ShardSupervisor(bot, _setup_worker, processes)
+    if _create_catch_up(bot, None).should_run():
+        log.warning("Update backlog is over the catch-up threshold, but catch-up is disabled "
+                    "with %s worker processes", processes)
+
+    def on_stop_signal(sig, _):
+        # the snapshot is written first, draining workers may outlast the stop grace period
+        _handle_sigterm(bot, poller, sig, dispatching=False)
+        supervisor.stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, on_stop_signal)
+    signal.signal(signal.SIGUSR1, lambda sig, _: supervisor.signal_workers(sig))
+    _send_message_admin(bot, f"Starting up now with {processes} worker processes")
+    supervisor.start()
+    poller.start()
+    supervisor.join()
+
+
 def main():
     token = os.environ["TELEGRAM_API_KEY"]
+    processes = int(os.environ.get("FOTC_WORKER_PROCESSES", 1))
+    if processes > 1:
+        _main_sharded(token, processes)
+        return
+
     updater = Updater(token)
     bot = updater.bot
-    poller = RemindersPoller(bot, interval=1)
+    _load_warm_cache()
+    poller = _create_reminders_poller(bot)
     updater.user_sig_handler = lambda sig, _: _handle_sigterm(updater.bot, poller, sig)
-    _register_command_handlers(updater)
+    signal.signal(signal.SIGUSR1, lambda sig, _: _handle_sigusr1(updater.bot, sig))
+    _register_command_handlers(updater.dispatcher)
     _send_message_admin(updater.bot, "Starting up now")
+    _catch_up_backlog(updater)
     poller.start()
     updater.start_polling()
     updater.idle()
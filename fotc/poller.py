@@ -6,6 +6,7 @@ import telegram
 import time
 import datetime
 
+from fotc.cache import warm_cache
 from fotc.database import Session, Reminder
 from sqlalchemy.orm.session import Session as DbSession
 
@@ -15,15 +16,28 @@ log = logging.getLogger("fotc")
 
 
 class RemindersPoller(object):
-    def __init__(self, bot: telegram.Bot, interval: float):
+    """
+    Sends reminders once they are due, tracking the pending schedule in memory
+
+    Each iteration only fetches reminders created after the newest one already scheduled. Since
+    concurrent transactions may commit ids out of order, the whole schedule is rebuilt from the
+    database every `reconcile_interval` seconds, and at startup unless a snapshot provided it. A
+    reminder committed with an id below the newest scheduled one can therefore be sent up to
+    `reconcile_interval` seconds late.
+    """
+    def __init__(self, bot: telegram.Bot, interval: float, reconcile_interval: float = 60):
         self.bot = bot
         self.interval = interval
-        self.thread = threading.Thread(target=self._poll_loop)
+        self.reconcile_interval = reconcile_interval
+        self.next_reconcile = 0.0
+        self.thread = threading.Thread(target=self._poll_loop, name="RemindersPoller")
         self.stop_event = threading.Event()
 
     def start(self):
         if self.thread.is_alive():
             return
+        if warm_cache.reminders_warm:
+            self.next_reconcile = time.monotonic() + self.reconcile_interval
         self.stop_event.clear()
         self.thread.start()
 
@@ -38,19 +52,38 @@ class RemindersPoller(object):
     def _poll_loop(self):
         while not self.stop_event.is_set():
             try:
-                session: DbSession = Session()
-                reminder_repo = ReminderRepository(session)
-                group_repo = ChatGroupRepository(session)
-                for reminder in reminder_repo.query_due_reminders():
-                    self._process_reminder(reminder, group_repo)
-                else:
-                    session.commit()
-
-                time.sleep(self.interval)
+                self._poll_once()
+                self.stop_event.wait(self.interval)
             except Exception: # catch-all to prevent any sort of crash
                 log.exception("Exception caught during reminder polling")
-                time.sleep(2.0)
+                self.stop_event.wait(2.0)
+
+    def _poll_once(self):
+        session: DbSession = Session()
+        try:
+            reminder_repo = ReminderRepository(session)
+            group_repo = ChatGroupRepository(session)
+            self._update_schedule(reminder_repo)
+            due_ids = warm_cache.due_reminders(datetime.datetime.utcnow())
+            due = reminder_repo.find_reminders(due_ids) if due_ids else []
+            for reminder in due:
+                if reminder.sent_on is None:
+                    self._process_reminder(reminder, group_repo)
+            session.commit()
+            # due ids missing from `due` were deleted, they are dropped from the schedule as well
+            warm_cache.remove_reminders(due_ids)
+        finally:
+            session.close()
+
+    def _update_schedule(self, reminder_repo: ReminderRepository):
+        if time.monotonic() >= self.next_reconcile:
+            pending = reminder_repo.query_pending_reminders()
+            warm_cache.replace_reminders({r.id: r.scheduled_for for r in pending})
+            self.next_reconcile = time.monotonic() + self.reconcile_interval
+            return
 
+        for reminder in reminder_repo.query_pending_reminders(warm_cache.last_reminder_id):
+            warm_cache.add_reminder(reminder.id, reminder.scheduled_for)
 
     def _process_reminder(self,  reminder: Reminder, group_repo: ChatGroupRepository):
         group_user = group_repo.find_group_user_by_id(reminder.group_user_id)
@@ -0,0 +1,179 @@
+# -*- encoding: utf-8 -*-
+
+import collections
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Text, Tuple
+
+log = logging.getLogger("fotc")
+
+StackKey = Tuple[Text, ...]
+
+# (file, function) of frames where an idle thread blocks, stacks ending in them are not sampled
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("queues.py", "get"),
+    ("connection.py", "_recv"),
+    ("connection.py", "_poll"),
+    ("selectors.py", "select"),
+    ("updater.py", "idle"),
+}
+
+# the Updater long-polls Telegram, its time in network reads is not handler work
+IGNORED_THREADS = ("updater",)
+
+
+class ProfileResult(object):
+    """
+    Aggregated samples collected by a SamplingProfiler run
+
+    `rounds` counts sampling passes over all threads, `samples` counts the busy thread stacks
+    recorded in them, which is what percentages are relative to.
+    """
+    def __init__(self, duration: float, rounds: int, stacks: Dict[StackKey, int]):
+        self.duration = duration
+        self.rounds = rounds
+        self.stacks = stacks
+        self.samples = sum(stacks.values())
+
+    def collapsed_stacks(self) -> List[Text]:
+        """
+        Returns stacks in the collapsed format understood by flamegraph.pl/speedscope
+
+        `thread;outer;inner 42` => one line per distinct stack, with its sample count
+        """
+        return [f"{';'.join(stack)} {count}"
+                for stack, count in sorted(self.stacks.items(), key=lambda kv: -kv[1])]
+
+    def top_functions(self, limit: int = 15) -> List[Tuple[Text, int, int]]:
+        """
+        Returns the hottest functions as (function, self samples, total samples)
+
+        Self samples count the function at the top of the stack, total samples count every stack
+        in which the function appears at least once.
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack[1:]  # skip thread name
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        ranked = sorted(total, key=lambda f: (own[f], total[f]), reverse=True)
+        return [(f, own[f], total[f]) for f in ranked[:limit]]
+
+    def summary(self, limit: int = 15) -> Text:
+        lines = [f"Profiled {self.duration:.1f}s, {self.rounds} rounds, "
+                 f"{self.samples} busy thread samples"]
+        if not self.samples:
+            return lines[0]
+        lines.append("self% total% function")
+        for func, own, total in self.top_functions(limit):
+            own_pct = 100.0 * own / self.samples
+            total_pct = 100.0 * total / self.samples
+            lines.append(f"{own_pct:5.1f} {total_pct:6.1f} {func}")
+        return "\n".join(lines)
+
+    def write_collapsed(self, path: Text):
+        with open(path, "w") as out:
+            out.write("\n".join(self.collapsed_stacks()))
+            out.write("\n")
+
+
+class SamplingProfiler(object):
+    """
+    Low-overhead statistical profiler that periodically snapshots the stacks of running threads
+
+    Sampling relies on `sys._current_frames()`, so no tracing hooks are installed and profiled
+    threads run unmodified. Every thread except the sampler and IGNORED_THREADS is sampled, which
+    covers the dispatcher and its workers and the RemindersPoller thread, but stacks that end in
+    one of IDLE_FRAMES are dropped so idle workers do not dominate the report.
+    """
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration: float, on_done: Callable[[ProfileResult], None]) -> bool:
+        """
+        Samples for `duration` seconds in a background thread and calls `on_done` with the result
+
+        Returns False if a profiling run is already in progress.
+        """
+        with self.lock:
+            if self.is_running():
+                return False
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(duration, on_done),
+                                           name="SamplingProfiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        if not self.is_running():
+            return
+        self.stop_event.set()
+        self.thread.join(timeout=10)
+
+    def _run(self, duration: float, on_done: Callable[[ProfileResult], None]):
+        try:
+            result = self.sample(duration)
+            on_done(result)
+        except Exception:  # never let profiling take the bot down
+            log.exception("Exception caught during profiling")
+
+    def sample(self, duration: float) -> ProfileResult:
+        """Samples the current process stacks for `duration` seconds, blocking the caller"""
+        stacks = collections.Counter()
+        rounds = 0
+        own_ident = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + duration
+        while time.monotonic() < deadline and not self.stop_event.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                name = names.get(ident, str(ident))
+                if name in IGNORED_THREADS or _is_idle(frame):
+                    continue
+                stacks[(name,) + _frame_stack(frame)] += 1
+            rounds += 1
+            self.stop_event.wait(self.interval)
+        return ProfileResult(time.monotonic() - started, rounds, dict(stacks))
+
+
+def write_report(result: ProfileResult, directory: Optional[Text] = None) -> Text:
+    """Writes the collapsed stacks of `result` to a new file and returns its path"""
+    fd, path = tempfile.mkstemp(prefix="fotc-profile-", suffix=".collapsed", dir=directory)
+    os.close(fd)
+    result.write_collapsed(path)
+    return path
+
+
+def _is_idle(frame) -> bool:
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+
+
+def _frame_stack(frame) -> StackKey:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 
-from typing import List, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
+import sqlalchemy as sqla
+
+from fotc.cache import warm_cache
 from fotc.database import ChatUser, GroupUser, ChatGroup, Reminder, ChatGroupUserQuote
-from sqlalchemy.orm.session import Session as DbSession
+from fotc.roster import roster_index
+from sqlalchemy.orm.session import Session as DbSession, make_transient_to_detached
 
 
 class ChatUserRepository(object):
@@ -18,19 +22,49 @@ class ChatUserRepository(object):
             self.session.add(user)
         return user
 
+    def find_or_create_many(self, user_ids: Iterable[int]) -> Dict[int, ChatUser]:
+        """Bulk version of find_or_create_by_id, issuing a single query for all ids"""
+        user_ids = set(user_ids)
+        users = {u.id: u for u in
+                 self.session.query(ChatUser).filter(ChatUser.id.in_(user_ids)).all()}
+        for user_id in user_ids - users.keys():
+            users[user_id] = ChatUser(id=user_id, last_active=None, timezone=None)
+            self.session.add(users[user_id])
+        return users
+
 
 class ChatGroupRepository(object):
     def __init__(self, session: DbSession):
         self.session = session
 
     def find_or_create_by_id(self, group_id: int) -> ChatGroup:
+        if warm_cache.has_group(group_id):
+            return _attach(self.session, ChatGroup(id=group_id))
+
         group = self.session.query(ChatGroup).filter(ChatGroup.id == group_id).first()
         if not group:
             group = ChatGroup(id=group_id)
             self.session.add(group)
+        else:
+            warm_cache.add_group(group.id)
         return group
 
+    def find_or_create_many(self, group_ids: Iterable[int]) -> Dict[int, ChatGroup]:
+        """Bulk version of find_or_create_by_id, issuing a single query for all ids"""
+        group_ids = set(group_ids)
+        groups = {g.id: g for g in
+                  self.session.query(ChatGroup).filter(ChatGroup.id.in_(group_ids)).all()}
+        for group_id in groups:
+            warm_cache.add_group(group_id)
+        for group_id in group_ids - groups.keys():
+            groups[group_id] = ChatGroup(id=group_id)
+            self.session.add(groups[group_id])
+        return groups
+
     def is_user_member(self, group: ChatGroup, user: ChatUser) -> bool:
+        is_member = roster_index.is_member(group.id, user.id)
+        if is_member is not None:
+            return is_member
         group_user = self._find_membership(group, user)
         return group_user is not None
 
@@ -41,6 +75,26 @@ class ChatGroupRepository(object):
             self.session.add(group_user)
         return group_user
 
+    def record_memberships(self, pairs: Iterable[Tuple[int, int]]) -> List[GroupUser]:
+        """Bulk version of record_membership for (user_id, group_id) pairs"""
+        pairs = set(pairs)
+        if not pairs:
+            return []
+        user_ids = {user_id for user_id, _ in pairs}
+        group_ids = {group_id for _, group_id in pairs}
+        existing = self.session.query(GroupUser) \
+            .filter(GroupUser.user_id.in_(user_ids)) \
+            .filter(GroupUser.group_id.in_(group_ids)) \
+            .all()
+        group_users = [gu for gu in existing if (gu.user_id, gu.group_id) in pairs]
+        for gu in group_users:
+            warm_cache.add_membership(gu.user_id, gu.group_id, gu.id)
+        for user_id, group_id in pairs - {(gu.user_id, gu.group_id) for gu in group_users}:
+            group_user = GroupUser(user_id=user_id, group_id=group_id)
+            self.session.add(group_user)
+            group_users.append(group_user)
+        return group_users
+
     def list_group_members(self, group: ChatGroup) -> List[ChatUser]:
         members = self.session.query(ChatUser) \
             .join(GroupUser, GroupUser.user_id == ChatUser.id) \
@@ -48,16 +102,31 @@ class ChatGroupRepository(object):
             .filter(ChatGroup.id == group.id)
         return members.all()
 
+    def load_roster(self, group: ChatGroup):
+        """Loads the roster index of `group` from the database unless it is already current"""
+        if roster_index.is_loaded(group.id):
+            return
+        members = self.list_group_members(group)
+        roster_index.load_group(group.id, [(u.id, u.timezone) for u in members])
+
     def find_group_user_by_id(self, group_user_id: int) -> Optional[GroupUser]:
         return self.session.query(GroupUser) \
             .filter(GroupUser.id == group_user_id) \
             .first()
 
     def _find_membership(self, group: ChatGroup, user: ChatUser) -> Optional[GroupUser]:
-        return self.session.query(GroupUser) \
+        group_user_id = warm_cache.membership_id(user.id, group.id)
+        if group_user_id is not None:
+            return _attach(self.session,
+                           GroupUser(id=group_user_id, user_id=user.id, group_id=group.id))
+
+        group_user = self.session.query(GroupUser) \
             .filter(GroupUser.group_id == group.id) \
             .filter(GroupUser.user_id == user.id) \
             .first()
+        if group_user:
+            warm_cache.add_membership(group_user.user_id, group_user.group_id, group_user.id)
+        return group_user
 
 
 class ReminderRepository(object):
@@ -79,6 +148,18 @@ class ReminderRepository(object):
             .filter(Reminder.scheduled_for <= datetime.utcnow()) \
             .all()
 
+    def query_pending_reminders(self, after_id: int = 0) -> List[Reminder]:
+        """Lists reminders not sent yet, optionally only those created after `after_id`"""
+        return self.session.query(Reminder) \
+            .filter(Reminder.sent_on.is_(None)) \
+            .filter(Reminder.id > after_id) \
+            .all()
+
+    def find_reminders(self, reminder_ids: Iterable[int]) -> List[Reminder]:
+        return self.session.query(Reminder) \
+            .filter(Reminder.id.in_(list(reminder_ids))) \
+            .all()
+
 
 class QuoteRepository(object):
     def __init__(self, session: DbSession):
@@ -101,3 +182,34 @@ class QuoteRepository(object):
             .filter(ChatGroupUserQuote.group_user_id == group_user.id) \
             .filter(ChatGroupUserQuote.message_ref == message_ref) \
             .one_or_none()
+
+
+def _attach(session: DbSession, obj):
+    """Attaches an object known to be persisted to the session without querying for it"""
+    make_transient_to_detached(obj)
+    return session.merge(obj, load=False)
+
+
+def after_commit(session: DbSession, callback: Callable[[], None]):
+    """
+    Runs `callback` once the current transaction of `session` commits
+
+    Callbacks are dropped when the transaction rolls back, so in-memory indexes are only updated
+    with changes that actually reached the database.
+    """
+    callbacks = session.info.get("fotc_after_commit")
+    if callbacks is None:
+        callbacks = session.info["fotc_after_commit"] = []
+        sqla.event.listen(session, "after_commit", _run_after_commit)
+        sqla.event.listen(session, "after_soft_rollback", _drop_after_commit)
+    callbacks.append(callback)
+
+
+def _run_after_commit(session: DbSession):
+    callbacks, session.info["fotc_after_commit"] = session.info["fotc_after_commit"], []
+    for callback in callbacks:
+        callback()
+
+
+def _drop_after_commit(session: DbSession, previous_transaction):
+    session.info["fotc_after_commit"] = []
@@ -0,0 +1,132 @@
+# -*- encoding: utf-8 -*-
+
+import bisect
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Text, Tuple
+
+import pytz
+
+
+class RosterMember(object):
+    __slots__ = ("user_id", "timezone", "name")
+
+    def __init__(self, user_id: int, timezone: Optional[Text], name: Optional[Text]):
+        self.user_id = user_id
+        self.timezone = timezone
+        self.name = name
+
+
+class RosterIndex(object):
+    """
+    In-memory index of group members, their timezones and display names
+
+    A group is loaded once from the database and then kept up to date incrementally from
+    membership and timezone changes. Loaded groups are reloaded after `ttl` seconds, which bounds
+    staleness for changes made by other processes.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.users: Dict[int, RosterMember] = {}
+        self.groups: Dict[int, Set[int]] = {}
+        self.loaded_at: Dict[int, float] = {}
+
+    def is_loaded(self, group_id: int) -> bool:
+        loaded_at = self.loaded_at.get(group_id)
+        return loaded_at is not None and time.monotonic() - loaded_at < self.ttl
+
+    def load_group(self, group_id: int, members: Iterable[Tuple[int, Optional[Text]]]):
+        """Replaces the roster of `group_id` with (user id, timezone) pairs from the database"""
+        with self.lock:
+            member_ids = set()
+            for user_id, timezone in members:
+                member = self.users.get(user_id)
+                if member is None:
+                    self.users[user_id] = RosterMember(user_id, timezone, None)
+                else:
+                    member.timezone = timezone
+                member_ids.add(user_id)
+            self.groups[group_id] = member_ids
+            self.loaded_at[group_id] = time.monotonic()
+
+    def add_member(self, group_id: int, user_id: int, timezone: Optional[Text],
+                   name: Optional[Text] = None):
+        with self.lock:
+            member = self.users.get(user_id)
+            if member is None:
+                member = self.users[user_id] = RosterMember(user_id, timezone, name)
+            member.timezone = timezone
+            member.name = name or member.name
+            if group_id in self.groups:
+                self.groups[group_id].add(user_id)
+
+    def set_timezone(self, user_id: int, timezone: Optional[Text]):
+        with self.lock:
+            member = self.users.get(user_id)
+            if member is not None:
+                member.timezone = timezone
+
+    def set_name(self, user_id: int, name: Text):
+        with self.lock:
+            member = self.users.get(user_id)
+            if member is not None:
+                member.name = name
+
+    def is_member(self, group_id: int, user_id: int) -> Optional[bool]:
+        """Answers membership for loaded groups, None when the group roster is not known"""
+        if not self.is_loaded(group_id):
+            return None
+        return user_id in self.groups[group_id]
+
+    def members_with_timezone(self, group_id: int) -> List[RosterMember]:
+        with self.lock:
+            return [self.users[u] for u in self.groups.get(group_id, ())
+                    if self.users[u].timezone is not None]
+
+
+class TimezoneCache(object):
+    """
+    Caches timezone objects along with the UTC offset in effect until their next transition
+
+    Converting to local time is then an addition and a tzinfo swap. An entry is recomputed once
+    the current time moves past the DST transition that bounds it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[Text, Tuple[datetime, datetime, timedelta, pytz.BaseTzInfo]] = {}
+
+    def localtime(self, tz_name: Text, now: Optional[datetime] = None) -> datetime:
+        """Converts `now` (naive UTC, defaults to the current time) to local time in `tz_name`"""
+        now = now or datetime.utcnow()
+        entry = self.entries.get(tz_name)
+        if entry is None or not entry[0] <= now < entry[1]:
+            entry = self._compute(tz_name, now)
+        _, _, offset, period_tz = entry
+        return (now + offset).replace(tzinfo=period_tz)
+
+    def _compute(self, tz_name: Text, now: datetime):
+        timezone = pytz.timezone(tz_name)
+        local = pytz.utc.localize(now).astimezone(timezone)
+        valid_from, valid_until = _transition_bounds(timezone, now)
+        entry = (valid_from, valid_until, local.utcoffset(), local.tzinfo)
+        with self.lock:
+            self.entries[tz_name] = entry
+        return entry
+
+
+def _transition_bounds(timezone: pytz.BaseTzInfo, now: datetime) -> Tuple[datetime, datetime]:
+    # DstTzInfo keeps its sorted transitions as naive UTC, static zones have none
+    transitions = getattr(timezone, "_utc_transition_times", None)
+    if not transitions:
+        return datetime.min, datetime.max
+    idx = bisect.bisect_right(transitions, now)
+    valid_from = transitions[idx - 1] if idx > 0 else datetime.min
+    valid_until = transitions[idx] if idx < len(transitions) else datetime.max
+    return valid_from, valid_until
+
+
+roster_index = RosterIndex(ttl=float(os.environ.get("FOTC_ROSTER_TTL", 600)))
+timezone_cache = TimezoneCache()
@@ -0,0 +1,243 @@
+# -*- encoding: utf-8 -*-
+
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Text, Tuple
+
+import telegram
+from telegram.ext import Dispatcher
+
+log = logging.getLogger("fotc")
+
+# workers are spawned rather than forked so they do not inherit database connections or threads
+_mp = multiprocessing.get_context("spawn")
+
+# configures a worker's dispatcher, optionally returning a callable run when the worker stops
+DispatcherSetup = Callable[[Dispatcher], Optional[Callable[[], None]]]
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to nodes
+
+    Every node is placed on the ring `replicas` times, so adding or removing a node only moves
+    roughly 1/N of the keys, all of them to or from the affected node.
+    """
+    def __init__(self, nodes: Tuple[Text, ...] = (), replicas: int = 64):
+        self.replicas = replicas
+        self.hashes: List[int] = []
+        self.owners: Dict[int, Text] = {}
+        for node in nodes:
+            self.add_node(node)
+
+    def nodes(self) -> List[Text]:
+        return sorted(set(self.owners.values()))
+
+    def add_node(self, node: Text):
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            if point in self.owners:
+                continue
+            self.owners[point] = node
+            bisect.insort(self.hashes, point)
+
+    def remove_node(self, node: Text):
+        points = [p for p, owner in self.owners.items() if owner == node]
+        for point in points:
+            del self.owners[point]
+            del self.hashes[bisect.bisect_left(self.hashes, point)]
+
+    def get_node(self, key) -> Optional[Text]:
+        if not self.hashes:
+            return None
+        idx = bisect.bisect(self.hashes, _hash(str(key))) % len(self.hashes)
+        return self.owners[self.hashes[idx]]
+
+
+def update_chat_id(data: dict) -> int:
+    """Extracts the chat id from a raw update, 0 for updates that are not bound to a chat"""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    callback_message = data.get("callback_query", {}).get("message")
+    if callback_message:
+        return callback_message["chat"]["id"]
+    return 0
+
+
+class ShardSupervisor(object):
+    """
+    Polls Telegram for updates and shards them across worker processes by chat id
+
+    Each worker runs its own Dispatcher configured by `setup`, so all updates of a given chat are
+    processed by the same process. A worker that dies is replaced under the same name, so its
+    chats go to the replacement along with the updates it had not picked up yet, and no other
+    chat moves.
+    """
+    def __init__(self, bot: telegram.Bot, setup: DispatcherSetup, processes: int,
+                 poll_timeout: float = 10):
+        self.bot = bot
+        self.setup = setup
+        self.processes = processes
+        self.poll_timeout = poll_timeout
+        self.ring = HashRing()
+        self.workers: Dict[Text, Tuple[multiprocessing.Process, multiprocessing.Queue]] = {}
+        self.worker_ids = itertools.count()
+        self.last_update_id = None
+        # fetched updates that are not routed yet are delivered again by Telegram on restart, so
+        # the poll thread does not need to be waited for on shutdown
+        self.thread = threading.Thread(target=self._poll_loop, name="ShardSupervisor",
+                                       daemon=True)
+        self.stop_event = threading.Event()
+        # serialises routing with shutdown, no update is routed after the stop sentinels
+        self.route_lock = threading.Lock()
+
+    def start(self):
+        if self.thread.is_alive():
+            return
+        for _ in range(self.processes):
+            self.add_worker()
+        self.stop_event.clear()
+        self.thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stops routing and waits up to `timeout` seconds in total for all workers to drain"""
+        with self.route_lock:
+            self.stop_event.set()
+            workers, self.workers = self.workers, {}
+            for name, (process, updates) in workers.items():
+                self.ring.remove_node(name)
+                if process.is_alive():
+                    updates.put(None)
+
+        deadline = time.monotonic() + timeout
+        for name, (process, _) in workers.items():
+            process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.error("%s did not stop after timeout", name)
+        log.info("Stopped %s workers", len(workers))
+
+    def join(self):
+        while self.thread.is_alive() and not self.stop_event.is_set():
+            self.thread.join(timeout=1)
+
+    def add_worker(self, name: Optional[Text] = None) -> Text:
+        """Starts a worker, reusing `name` takes over exactly the chats a previous worker owned"""
+        name = name or f"worker-{next(self.worker_ids)}"
+        updates = _mp.Queue()
+        process = _mp.Process(target=_worker_main, name=name, daemon=True,
+                              args=(self.bot.token, updates, self.setup))
+        process.start()
+        self.workers[name] = (process, updates)
+        self.ring.add_node(name)
+        log.info("Started %s (pid %s), %s workers active", name, process.pid, len(self.workers))
+        return name
+
+    def remove_worker(self, name: Text):
+        """Stops routing to `name` and waits for it to drain the updates it already received"""
+        self.ring.remove_node(name)
+        process, updates = self.workers.pop(name)
+        if process.is_alive():
+            updates.put(None)
+            process.join(timeout=30)
+            if process.is_alive():
+                log.error("%s did not stop after timeout", name)
+        log.info("Removed %s, %s workers active", name, len(self.workers))
+
+    def route(self, data: dict) -> Text:
+        """Forwards a raw update to the worker owning its chat, returning the worker name"""
+        name = self.ring.get_node(update_chat_id(data))
+        _, updates = self.workers[name]
+        updates.put(data)
+        return name
+
+    def signal_workers(self, sig: int):
+        """Forwards a signal to every live worker process"""
+        for process, _ in list(self.workers.values()):
+            if process.is_alive():
+                os.kill(process.pid, sig)
+
+    def _poll_loop(self):
+        webhook_deleted = False
+        while not self.stop_event.is_set():
+            try:
+                if not webhook_deleted:
+                    # getUpdates is refused while a webhook is set, same as Updater._bootstrap
+                    self.bot.delete_webhook()
+                    webhook_deleted = True
+                with self.route_lock:
+                    if self.stop_event.is_set():
+                        return
+                    self._replace_dead_workers()
+                updates = self.bot.get_updates(self.last_update_id, timeout=self.poll_timeout)
+                for update in updates:
+                    with self.route_lock:
+                        if self.stop_event.is_set():
+                            return
+                        self.route(update.to_dict())
+                    self.last_update_id = update.update_id + 1
+            except Exception: # catch-all to keep the supervisor polling
+                log.exception("Exception caught while polling updates for shard workers")
+                self.stop_event.wait(2.0)
+
+    def _replace_dead_workers(self):
+        for name, (process, updates) in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            log.error("%s exited with code %s, replacing it", name, process.exitcode)
+            self.remove_worker(name)
+            self.add_worker(name)
+            pending = _drain(updates)
+            updates.close()
+            for data in pending:
+                self.route(data)
+            # the update being handled when the worker died is lost with it
+            log.warning("Requeued %s updates left by %s", len(pending), name)
+
+
+def _worker_main(token: Text, updates: multiprocessing.Queue, setup: DispatcherSetup):
+    # shutdown is driven by the supervisor through the queue sentinel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    bot = telegram.Bot(token)
+    # never started, the queue is only exposed so handlers can observe the backlog
+    dispatcher = Dispatcher(bot, updates, workers=0)
+    teardown = setup(dispatcher)
+    try:
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            dispatcher.process_update(telegram.Update.de_json(data, bot))
+    finally:
+        if teardown is not None:
+            teardown()
+
+
+def _drain(updates: multiprocessing.Queue) -> List[dict]:
+    """Takes the updates a dead worker left in its queue"""
+    pending = []
+    while True:
+        try:
+            data = updates.get(timeout=0.1)
+        except queue.Empty:
+            return pending
+        except Exception: # e.g. a message the dead worker was halfway through reading
+            log.exception("Failed to read updates left by a dead worker, %s recovered",
+                          len(pending))
+            return pending
+        if data is not None:
+            pending.append(data)
+
+
+def _hash(key: Text) -> int:
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
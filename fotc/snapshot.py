@@ -0,0 +1,164 @@
+# -*- encoding: utf-8 -*-
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Text
+
+from sqlalchemy.orm.session import Session as DbSession
+
+from fotc.cache import WarmCache
+from fotc.database import Session, ChatGroup, GroupUser
+
+log = logging.getLogger("fotc")
+
+MAGIC = b"FOTCSNAP"
+VERSION = 2
+
+# magic, version, created_at, last_reminder_id, #groups, #memberships, #reminders
+HEADER = struct.Struct("<8sIqqIII")
+GROUP = struct.Struct("<q")
+MEMBERSHIP = struct.Struct("<qqq")  # user id, group id, group_user id
+REMINDER = struct.Struct("<qd")  # reminder id, scheduled_for as UTC epoch seconds
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_snapshot(cache: WarmCache, path: Text):
+    """
+    Writes the cache contents to `path` as a compact little-endian binary file
+
+    The header is followed by fixed-width group, membership and reminder records, so sections can
+    be read straight from a memory map. The file is written next to `path` and renamed over it,
+    readers never observe a partial snapshot.
+    """
+    with cache.lock:
+        groups = sorted(cache.groups)
+        memberships = dict(cache.memberships)
+        reminders = dict(cache.reminders)
+        last_reminder_id = cache.last_reminder_id
+
+    chunks = [HEADER.pack(MAGIC, VERSION, int(time.time()), last_reminder_id, len(groups),
+                          len(memberships), len(reminders))]
+    chunks.extend(GROUP.pack(gid) for gid in groups)
+    chunks.extend(MEMBERSHIP.pack(uid, gid, guid) for (uid, gid), guid in memberships.items())
+    chunks.extend(REMINDER.pack(rid, (when - EPOCH).total_seconds())
+                  for rid, when in reminders.items())
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(b"".join(chunks))
+        # the data has to be durable before the rename, or a crash may leave an empty snapshot
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(cache: WarmCache, path: Text) -> bool:
+    """Loads a snapshot written by write_snapshot into `cache`, returning False if there is none"""
+    if not os.path.exists(path):
+        return False
+    # also rules out empty files, which cannot be memory mapped
+    if os.path.getsize(path) < HEADER.size:
+        raise SnapshotError(f"Snapshot {path} is truncated")
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        magic, version, created_at, last_reminder_id, n_groups, n_memberships, n_reminders = \
+            HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError(f"Unsupported snapshot format in {path}")
+
+        offset = HEADER.size
+
+        def records(record: struct.Struct, count: int):
+            nonlocal offset
+            end = offset + record.size * count
+            if end > len(buf):
+                raise SnapshotError(f"Snapshot {path} is truncated")
+            chunk, offset = buf[offset:end], end
+            return record.iter_unpack(chunk)
+
+        groups = {gid for (gid,) in records(GROUP, n_groups)}
+        memberships = {(uid, gid): guid for uid, gid, guid in records(MEMBERSHIP, n_memberships)}
+        reminders = {rid: EPOCH + timedelta(seconds=ts)
+                     for rid, ts in records(REMINDER, n_reminders)}
+
+    with cache.lock:
+        cache.groups.update(groups)
+        cache.memberships.update(memberships)
+        cache.replace_reminders(reminders)
+        cache.last_reminder_id = max(cache.last_reminder_id, last_reminder_id)
+
+    age = time.time() - created_at
+    log.info("Loaded snapshot from %s (%.0fs old): %s groups, %s memberships, %s reminders",
+             path, age, len(groups), len(memberships), len(reminders))
+    return True
+
+
+def verify_snapshot(cache: WarmCache, session: DbSession):
+    """
+    Checks snapshot contents against the database, evicting entries that no longer hold
+
+    Reminders are not checked here, RemindersPoller periodically reconciles its schedule.
+    """
+    with cache.lock:
+        group_ids = list(cache.groups)
+        memberships = dict(cache.memberships)
+
+    existing_groups = set()
+    if group_ids:
+        existing_groups = {gid for (gid,) in session.query(ChatGroup.id)
+                           .filter(ChatGroup.id.in_(group_ids)).all()}
+    existing_memberships = {}
+    if memberships:
+        rows = session.query(GroupUser.id, GroupUser.user_id, GroupUser.group_id) \
+            .filter(GroupUser.id.in_(list(memberships.values()))) \
+            .all()
+        existing_memberships = {(uid, gid): guid for guid, uid, gid in rows}
+
+    with cache.lock:
+        cache.groups.difference_update(set(group_ids) - existing_groups)
+        for key, group_user_id in memberships.items():
+            if existing_memberships.get(key) != group_user_id:
+                cache.memberships.pop(key, None)
+
+    evicted = (len(group_ids) - len(existing_groups)) + \
+        (len(memberships) - len(existing_memberships))
+    log.info("Snapshot verified against database, %s stale entries evicted", evicted)
+
+
+def verify_snapshot_async(cache: WarmCache) -> threading.Thread:
+    def run():
+        session: DbSession = Session()
+        try:
+            verify_snapshot(cache, session)
+        except Exception: # unverified entries must not outlive a failed check
+            log.exception("Failed to verify snapshot, clearing warm cache")
+            cache.clear()
+        finally:
+            session.close()
+
+    thread = threading.Thread(target=run, name="SnapshotVerifier", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_snapshot_path(process_name: Optional[Text] = None) -> Optional[Text]:
+    """
+    Returns the snapshot path from FOTC_SNAPSHOT_PATH, None when snapshots are disabled
+
+    Each shard worker keeps its own caches, so its snapshot is stored next to the supervisor's
+    with `process_name` as suffix.
+    """
+    path = os.environ.get("FOTC_SNAPSHOT_PATH", None)
+    if path and process_name:
+        return f"{path}.{process_name}"
+    return path
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import pytest
+import sqlalchemy as sqla
+from sqlalchemy.orm import sessionmaker
+
+from fotc.cache import warm_cache
+from fotc.database import Base
+
+
+@pytest.fixture
+def db_engine():
+    engine = sqla.create_engine("sqlite://")
+    # models live in the "fotc" schema, which SQLite only knows as an attached database
+    sqla.event.listen(engine, "connect",
+                      lambda conn, _: conn.execute("ATTACH DATABASE ':memory:' AS fotc"))
+    Base.metadata.create_all(engine)
+    yield engine
+    warm_cache.clear()
+
+
+@pytest.fixture
+def db_session(db_engine):
+    session = sessionmaker(bind=db_engine)()
+    yield session
+    session.close()
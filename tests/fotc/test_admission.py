@@ -0,0 +1,74 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import time
+
+from fotc.admission import AdmissionController, TokenBucket, COMMAND, PRESENCE, WELCOME_BACK
+
+
+def _controller(**kwargs):
+    settings = dict(chat_rate=0, chat_burst=10, global_rate=0, global_burst=100,
+                    max_queue_depth=100, max_db_latency=0.5)
+    settings.update(kwargs)
+    return AdmissionController(**settings)
+
+
+def test_low_priority_cannot_drain_reserved_tokens():
+    controller = _controller()
+    assert sum(controller.admit(1, WELCOME_BACK) for _ in range(10)) == 5
+    assert sum(controller.admit(1, PRESENCE) for _ in range(10)) == 3
+    assert sum(controller.admit(1, COMMAND) for _ in range(10)) == 2
+    assert controller.admit(2, COMMAND)
+    assert controller.shed[(WELCOME_BACK, "chat-rate")] == 5
+    assert controller.shed[(COMMAND, "chat-rate")] == 8
+
+
+def test_overload_sheds_everything_below_commands():
+    controller = _controller()
+    controller.queue_depth = lambda: 101
+    assert not controller.admit(1, PRESENCE)
+    assert not controller.admit(1, WELCOME_BACK)
+    assert controller.admit(1, COMMAND)
+
+    controller.queue_depth = lambda: 0
+    controller.record_db_latency(10.0)
+    assert not controller.admit(1, PRESENCE)
+    assert controller.shed[(PRESENCE, "overload")] == 2
+    assert "presence: admitted 0, shed 2 (overload 2)" in controller.summary()
+
+
+def test_optional_work_is_gated_without_taking_tokens():
+    controller = _controller()
+    assert sum(controller.admit(1, PRESENCE) for _ in range(4)) == 4
+    assert controller.allows(1, WELCOME_BACK)
+    assert controller.chat_buckets[1].tokens == 6
+    assert controller.admit(1, PRESENCE) and controller.admit(1, PRESENCE)
+    assert not controller.allows(1, WELCOME_BACK)
+    assert controller.shed[(WELCOME_BACK, "chat-rate")] == 1
+
+
+def test_idle_chat_buckets_are_evicted():
+    controller = _controller(chat_rate=1)
+    controller.admit(1, COMMAND)
+    controller.chat_buckets[1].updated -= 60
+    controller.chat_buckets[2] = TokenBucket(rate=0, burst=10)
+    controller.chat_buckets[2].take()
+    controller.next_eviction = 0.0
+    controller.admit(3, COMMAND)
+    assert set(controller.chat_buckets) == {2, 3}
+
+
+def test_db_latency_only_counts_statements(db_engine, db_session):
+    controller = _controller()
+    controller.track_db_latency(db_engine)
+    db_session.execute("SELECT 1")
+    time.sleep(0.2)
+    db_session.commit()
+    assert 0 < controller.db_latency < 0.05
+
+
+def test_global_refusal_keeps_chat_tokens():
+    controller = _controller(global_burst=3)
+    assert sum(controller.admit(1, COMMAND) for _ in range(5)) == 3
+    assert controller.chat_buckets[1].tokens == 7
+    assert controller.shed[(COMMAND, "global-rate")] == 2
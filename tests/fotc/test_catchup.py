@@ -0,0 +1,104 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+import telegram
+
+import fotc.catchup
+from fotc.catchup import BacklogCatchUp, record_presence_bulk
+from fotc.database import ChatUser, GroupUser
+from fotc.repository import ChatGroupRepository
+from fotc.roster import RosterIndex
+
+
+class FakeBot(object):
+    def __init__(self, updates, fail_after=None):
+        self.updates = updates
+        self.fail_after = fail_after
+
+    def get_updates(self, offset=None, limit=100, timeout=0):
+        offset = offset or 0
+        if self.fail_after is not None and offset > self.fail_after:
+            raise telegram.error.NetworkError("connection reset")
+        return [u for u in self.updates if u.update_id >= offset][:limit]
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.processed = []
+
+    def process_update(self, update):
+        self.processed.append(update)
+
+
+def _make_update(update_id, user_id, chat_id, text, age):
+    user = telegram.User(user_id, "user", False)
+    chat = telegram.Chat(chat_id, telegram.Chat.GROUP)
+    message = telegram.Message(update_id, user, datetime.now() - age, chat, text=text)
+    return telegram.Update(update_id, message=message)
+
+
+def test_catch_up_folds_presence_and_drops_stale_commands():
+    updates = [
+        _make_update(1, 10, -1, "hello", timedelta(hours=2)),
+        _make_update(2, 10, -1, "again", timedelta(hours=1)),
+        _make_update(3, 11, -1, "/greet", timedelta(hours=1)),
+        _make_update(4, 12, -1, "/greet", timedelta(seconds=5)),
+    ]
+    dispatcher = FakeDispatcher()
+    catch_up = BacklogCatchUp(FakeBot(updates), dispatcher, threshold=0,
+                              max_age=timedelta(minutes=5))
+    catch_up._write_presence = lambda: None
+
+    assert catch_up.run() == 5
+    assert [u.update_id for u in dispatcher.processed] == [4]
+    assert set(catch_up.presence.keys()) == {(10, -1), (11, -1)}
+    assert catch_up.folded == 2
+    assert catch_up.dropped == 1
+
+
+def test_catch_up_interrupted_keeps_processed_batches(db_session, monkeypatch):
+    monkeypatch.setattr(fotc.catchup, "Session", lambda: db_session)
+    updates = [_make_update(i, 10, -1, "hello", timedelta(minutes=1)) for i in range(1, 151)]
+    catch_up = BacklogCatchUp(FakeBot(updates, fail_after=100), FakeDispatcher(), threshold=0,
+                              max_age=timedelta(minutes=5))
+
+    assert catch_up.run() == 101
+    assert catch_up.processed == 100
+    assert db_session.query(GroupUser).count() == 1
+
+
+def test_record_presence_bulk(db_session):
+    earlier = datetime(2018, 6, 1, 10, 0)
+    later = datetime(2018, 6, 1, 12, 0)
+    db_session.add(ChatUser(id=1, last_active=later, timezone=None))
+    db_session.commit()
+    group_repo = ChatGroupRepository(db_session)
+    existing = group_repo.record_memberships([(1, -1)])
+    db_session.commit()
+
+    record_presence_bulk(db_session, {(1, -1): earlier, (1, -2): earlier, (2, -1): later})
+    db_session.commit()
+
+    users = {u.id: u.last_active for u in db_session.query(ChatUser).all()}
+    assert users == {1: later, 2: later}
+    pairs = {(gu.user_id, gu.group_id): gu.id for gu in db_session.query(GroupUser).all()}
+    assert set(pairs) == {(1, -1), (1, -2), (2, -1)}
+    assert pairs[(1, -1)] == existing[0].id
+    assert {gu.id for gu in group_repo.record_memberships(pairs)} == set(pairs.values())
+
+
+def test_record_presence_bulk_updates_roster_after_commit(db_session, monkeypatch):
+    roster = RosterIndex(ttl=600)
+    roster.load_group(-1, [])
+    monkeypatch.setattr(fotc.catchup, "roster_index", roster)
+    db_session.add(ChatUser(id=1, timezone="Asia/Tokyo"))
+    db_session.commit()
+
+    record_presence_bulk(db_session, {(1, -1): datetime(2018, 6, 1), (2, -1): datetime(2018, 6, 1)})
+    assert not roster.is_member(-1, 1)
+    db_session.commit()
+
+    assert roster.is_member(-1, 1) and roster.is_member(-1, 2)
+    assert [m.user_id for m in roster.members_with_timezone(-1)] == [1]
@@ -15,4 +15,45 @@ def test_memegen_str():
     out = fotc.util.memegen_str('a string with spaces')
     assert out == "a_string_with_spaces"
     empty = fotc.util.memegen_str('')
-    assert empty == '_'
\ No newline at end of file
+    assert empty == '_'
+
+class FakeMessage(object):
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUpdate(object):
+    def __init__(self, chat_id, text):
+        self.effective_chat = type("Chat", (object,), {"id": chat_id})()
+        self.message = FakeMessage(text)
+
+
+def test_profile_handler_rejects_non_finite_duration(monkeypatch):
+    monkeypatch.setenv("TELEGRAM_ADMIN_CHATID", "-1")
+    started = []
+    monkeypatch.setattr(fm, "_start_profiling", lambda bot, duration: started.append(duration))
+    for text in ("/profile nan", "/profile inf", "/profile soon"):
+        update = FakeUpdate(-1, text)
+        fm.profile_handler(None, update)
+        assert update.message.replies == ["Duration must be a number of seconds"]
+    fm.profile_handler(None, FakeUpdate(-1, "/profile 5"))
+    assert started == [5.0]
+
+
+def test_profile_report_removed_once_sent(monkeypatch, tmpdir):
+    monkeypatch.setenv("FOTC_PROFILE_DIR", str(tmpdir))
+    monkeypatch.setattr(fm, "_send_message_admin", lambda bot, text, **kwargs: None)
+    result = fm.ProfileResult(duration=1.0, rounds=1, stacks={("main", "f (a.py:1)"): 1})
+
+    monkeypatch.delenv("TELEGRAM_ADMIN_CHATID", raising=False)
+    fm._on_profile_done(None, result)
+    assert len(tmpdir.listdir()) == 1
+
+    monkeypatch.setenv("TELEGRAM_ADMIN_CHATID", "-1")
+    bot = type("Bot", (object,), {"send_document": lambda self, chat_id, document, **kw: None})()
+    fm._on_profile_done(bot, result)
+    assert len(tmpdir.listdir()) == 1
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+import telegram
+
+import fotc.poller
+from fotc.cache import warm_cache
+from fotc.database import ChatGroup, ChatUser, GroupUser, Reminder
+from fotc.poller import RemindersPoller
+
+
+class FakeBot(object):
+    def __init__(self):
+        self.sent = []
+
+    def get_chat_member(self, chat_id, user_id):
+        return telegram.ChatMember(telegram.User(user_id, "user", False), "member")
+
+    def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+        self.sent.append((chat_id, reply_to_message_id))
+
+
+def _add_reminder(session, reminder_id, scheduled_for, message_ref="1"):
+    session.add(Reminder(id=reminder_id, group_user_id=1, message_ref=message_ref,
+                         scheduled_for=scheduled_for, sent_on=None))
+    session.commit()
+
+
+def _create_poller(db_session, monkeypatch):
+    monkeypatch.setattr(fotc.poller, "Session", lambda: db_session)
+    db_session.add_all([ChatUser(id=10, timezone=None), ChatGroup(id=-1)])
+    db_session.add(GroupUser(id=1, user_id=10, group_id=-1))
+    db_session.commit()
+    return RemindersPoller(FakeBot(), interval=1, reconcile_interval=3600)
+
+
+def test_poller_sends_due_reminders(db_session, monkeypatch):
+    poller = _create_poller(db_session, monkeypatch)
+    _add_reminder(db_session, 1, datetime.utcnow() - timedelta(minutes=1), message_ref="42")
+    _add_reminder(db_session, 2, datetime.utcnow() + timedelta(hours=1))
+
+    poller._poll_once()
+
+    assert poller.bot.sent == [(-1, "42")]
+    assert db_session.query(Reminder).get(1).sent_on is not None
+    assert set(warm_cache.reminders) == {2}
+
+
+def test_poller_picks_up_out_of_order_ids_at_reconcile(db_session, monkeypatch):
+    poller = _create_poller(db_session, monkeypatch)
+    _add_reminder(db_session, 5, datetime.utcnow() + timedelta(hours=1))
+    poller._poll_once()
+    assert warm_cache.last_reminder_id == 5
+
+    # committed after id 5 by a slower transaction, invisible to the incremental fetch
+    _add_reminder(db_session, 3, datetime.utcnow() - timedelta(minutes=1))
+    poller._poll_once()
+    assert poller.bot.sent == []
+    assert set(warm_cache.reminders) == {5}
+
+    poller.next_reconcile = 0.0
+    poller._poll_once()
+    assert len(poller.bot.sent) == 1
+    assert set(warm_cache.reminders) == {5}
+
+
+def test_poller_drops_reminders_sent_or_deleted_elsewhere(db_session, monkeypatch):
+    poller = _create_poller(db_session, monkeypatch)
+    due = datetime.utcnow() + timedelta(seconds=1)
+    _add_reminder(db_session, 1, due)
+    _add_reminder(db_session, 2, due)
+    poller._poll_once()
+    assert set(warm_cache.reminders) == {1, 2}
+
+    db_session.query(Reminder).get(1).sent_on = datetime.utcnow()
+    db_session.delete(db_session.query(Reminder).get(2))
+    db_session.commit()
+    warm_cache.replace_reminders({1: due - timedelta(hours=1), 2: due - timedelta(hours=1)})
+    poller._poll_once()
+
+    assert poller.bot.sent == []
+    assert warm_cache.reminders == {}
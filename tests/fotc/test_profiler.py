@@ -0,0 +1,44 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import threading
+
+from fotc.profiler import ProfileResult, SamplingProfiler
+
+
+def test_profile_result_summary():
+    stacks = {
+        ("dispatcher", "start (dispatcher.py:1)", "handler (main.py:10)"): 3,
+        ("dispatcher", "start (dispatcher.py:1)"): 1,
+    }
+    result = ProfileResult(duration=1.0, rounds=4, stacks=stacks)
+    assert result.collapsed_stacks()[0] == \
+        "dispatcher;start (dispatcher.py:1);handler (main.py:10) 3"
+    top = result.top_functions()
+    assert top[0] == ("handler (main.py:10)", 3, 3)
+    assert top[1] == ("start (dispatcher.py:1)", 1, 4)
+
+
+def _spin(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_sampling_profiler_skips_idle_threads():
+    stop = threading.Event()
+    idle = [threading.Thread(target=stop.wait, name=f"idle-{i}") for i in range(5)]
+    busy = threading.Thread(target=_spin, args=(stop,), name="busy")
+    for thread in idle + [busy]:
+        thread.start()
+    try:
+        result = SamplingProfiler(interval=0.001).sample(0.1)
+    finally:
+        stop.set()
+        for thread in idle + [busy]:
+            thread.join()
+
+    assert result.samples > 0
+    assert {stack[0] for stack in result.stacks} <= {"busy", "MainThread"}
+    assert any(stack[0] == "busy" for stack in result.stacks)
+    assert all(own <= total <= result.samples for _, own, total in result.top_functions())
+    assert "wait (threading.py" not in result.summary()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import sqlalchemy as sqla
+
+from fotc.cache import warm_cache
+from fotc.database import ChatGroup, ChatUser, GroupUser
+from fotc.repository import ChatGroupRepository, after_commit
+
+
+def _count_selects(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    sqla.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+
+def test_cached_group_and_membership_are_attached_without_select(db_engine, db_session):
+    db_session.add_all([ChatUser(id=10, timezone="UTC"), ChatGroup(id=-1)])
+    db_session.add(GroupUser(id=7, user_id=10, group_id=-1))
+    db_session.commit()
+    warm_cache.add_group(-1)
+    warm_cache.add_membership(10, -1, 7)
+    user = db_session.query(ChatUser).get(10)
+
+    selects = _count_selects(db_engine)
+    group_repo = ChatGroupRepository(db_session)
+    group = group_repo.find_or_create_by_id(-1)
+    group_user = group_repo.record_membership(group, user)
+    assert selects == []
+
+    assert group_user.id == 7
+    assert group_user.user.timezone == "UTC"
+    db_session.commit()
+    assert db_session.query(GroupUser).count() == 1
+    assert db_session.query(ChatGroup).count() == 1
+
+
+def test_uncached_membership_is_queried_and_cached(db_engine, db_session):
+    db_session.add_all([ChatUser(id=10, timezone=None), ChatGroup(id=-1)])
+    db_session.add(GroupUser(id=7, user_id=10, group_id=-1))
+    db_session.commit()
+
+    group_repo = ChatGroupRepository(db_session)
+    group = group_repo.find_or_create_by_id(-1)
+    group_repo.record_membership(group, db_session.query(ChatUser).get(10))
+
+    assert warm_cache.has_group(-1)
+    assert warm_cache.membership_id(10, -1) == 7
+
+
+def test_after_commit_runs_only_for_committed_transactions(db_session):
+    calls = []
+    after_commit(db_session, lambda: calls.append("rolled back"))
+    db_session.add(ChatGroup(id=-1))
+    db_session.rollback()
+    after_commit(db_session, lambda: calls.append("committed"))
+    db_session.add(ChatGroup(id=-2))
+    assert calls == []
+
+    db_session.commit()
+    db_session.commit()
+    assert calls == ["committed"]
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from fotc.roster import RosterIndex, TimezoneCache
+
+
+def test_roster_index_incremental_updates():
+    roster = RosterIndex(ttl=600)
+    roster.add_member(-1, 10, None, "before load")
+    assert roster.is_member(-1, 10) is None
+
+    roster.load_group(-1, [(10, None), (11, "Europe/Berlin")])
+    roster.add_member(-1, 12, "Asia/Tokyo", "tokyo")
+    roster.set_timezone(10, "America/Sao_Paulo")
+    assert roster.is_member(-1, 12)
+    assert not roster.is_member(-1, 13)
+
+    members = {m.user_id: m for m in roster.members_with_timezone(-1)}
+    assert set(members) == {10, 11, 12}
+    assert members[10].name == "before load"
+    assert members[10].timezone == "America/Sao_Paulo"
+
+
+def test_timezone_cache_matches_pytz_across_dst():
+    cache = TimezoneCache()
+    berlin = pytz.timezone("Europe/Berlin")
+    # DST started at 2018-03-25 01:00 UTC
+    start = datetime(2018, 3, 25, 0, 0)
+    for minutes in range(0, 180, 15):
+        now = start + timedelta(minutes=minutes)
+        expected = pytz.utc.localize(now).astimezone(berlin)
+        local = cache.localtime("Europe/Berlin", now)
+        assert local == expected
+        assert local.strftime("%H:%M %Z%z") == expected.strftime("%H:%M %Z%z")
+
+    assert cache.localtime("UTC", start).strftime("%H:%M %Z") == "00:00 UTC"
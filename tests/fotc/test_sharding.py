@@ -0,0 +1,102 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+import collections
+import functools
+import multiprocessing
+import os
+
+import telegram
+from telegram.ext import TypeHandler
+
+from fotc.sharding import HashRing, ShardSupervisor, update_chat_id
+
+
+def _recorded_update(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1528000000 + update_id,
+            "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": update_id, "is_bot": False, "first_name": "user"},
+            "text": "hello",
+        },
+    }
+
+
+def _record_chats(results, dispatcher):
+    callback = lambda bot, update: results.put((os.getpid(), update.effective_chat.id))
+    dispatcher.add_handler(TypeHandler(telegram.Update, callback))
+    return lambda: results.put((os.getpid(), "stopped"))
+
+
+def test_hash_ring_minimal_reassignment():
+    ring = HashRing(("worker-0", "worker-1", "worker-2"))
+    before = {key: ring.get_node(key) for key in range(3000)}
+    assert set(before.values()) == {"worker-0", "worker-1", "worker-2"}
+
+    ring.add_node("worker-3")
+    after = {key: ring.get_node(key) for key in range(3000)}
+    moved = [key for key in before if before[key] != after[key]]
+    assert all(after[key] == "worker-3" for key in moved)
+    assert 300 < len(moved) < 1200
+
+    ring.remove_node("worker-3")
+    assert {key: ring.get_node(key) for key in range(3000)} == before
+
+
+def test_update_chat_id():
+    assert update_chat_id(_recorded_update(1, -42)) == -42
+    assert update_chat_id({"update_id": 1, "inline_query": {}}) == 0
+
+
+def test_supervisor_routes_recorded_updates_by_chat():
+    results = multiprocessing.get_context("spawn").Queue()
+    setup = functools.partial(_record_chats, results)
+    supervisor = ShardSupervisor(telegram.Bot("123:fake"), setup, processes=2)
+    for _ in range(supervisor.processes):
+        supervisor.add_worker()
+
+    updates = [_recorded_update(i, -(i % 10)) for i in range(1, 101)]
+    routed = {update_chat_id(u): supervisor.route(u) for u in updates}
+    pids = {name: process.pid for name, (process, _) in supervisor.workers.items()}
+    for name in list(supervisor.workers):
+        supervisor.remove_worker(name)
+
+    handled = collections.defaultdict(set)
+    for _ in range(len(updates) + len(pids)):
+        pid, chat_id = results.get(timeout=10)
+        handled[chat_id].add(pid)
+    assert handled.pop("stopped") == set(pids.values())
+    assert all(handled[chat_id] == {pids[name]} for chat_id, name in routed.items())
+    assert len(handled) == 10
+
+
+def test_dead_worker_is_replaced_under_its_name():
+    results = multiprocessing.get_context("spawn").Queue()
+    setup = functools.partial(_record_chats, results)
+    supervisor = ShardSupervisor(telegram.Bot("123:fake"), setup, processes=3)
+    for _ in range(supervisor.processes):
+        supervisor.add_worker()
+    owners = {chat_id: supervisor.ring.get_node(chat_id) for chat_id in range(1000)}
+
+    process, updates = supervisor.workers["worker-1"]
+    process.terminate()
+    process.join()
+    left = [_recorded_update(i, chat_id) for i, chat_id in enumerate(range(1000), 1)
+            if owners[chat_id] == "worker-1"][:5]
+    for data in left:
+        updates.put(data)
+    supervisor._replace_dead_workers()
+
+    assert sorted(supervisor.workers) == ["worker-0", "worker-1", "worker-2"]
+    assert {chat_id: supervisor.ring.get_node(chat_id) for chat_id in range(1000)} == owners
+    replacement = supervisor.workers["worker-1"][0].pid
+    supervisor.stop()
+
+    handled = [results.get(timeout=10) for _ in range(len(left) + 3)]
+    assert sorted(chat_id for pid, chat_id in handled if chat_id != "stopped") == \
+        sorted(update_chat_id(data) for data in left)
+    assert {pid for pid, chat_id in handled if chat_id != "stopped"} == {replacement}
+    assert not supervisor.workers
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3.6
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+import pytest
+import pytz
+
+from fotc.cache import WarmCache
+from fotc.snapshot import SnapshotError, get_snapshot_path, load_snapshot, write_snapshot
+
+
+def test_snapshot_roundtrip(tmpdir):
+    cache = WarmCache()
+    cache.add_group(-100)
+    cache.add_membership(1, -100, 7)
+    cache.add_reminder(5, datetime(2018, 6, 1, 12, 30, 15))
+    cache.add_reminder(6, pytz.timezone("Europe/Berlin").localize(datetime(2018, 6, 1, 14, 0)))
+
+    path = str(tmpdir.join("fotc.snapshot"))
+    write_snapshot(cache, path)
+    loaded = WarmCache()
+    assert load_snapshot(loaded, path)
+
+    assert loaded.groups == {-100}
+    assert loaded.memberships == {(1, -100): 7}
+    assert loaded.reminders == {5: datetime(2018, 6, 1, 12, 30, 15),
+                                6: datetime(2018, 6, 1, 12, 0)}
+    assert loaded.last_reminder_id == 6
+    assert loaded.reminders_warm
+
+
+def test_snapshot_missing_or_invalid(tmpdir):
+    assert not load_snapshot(WarmCache(), str(tmpdir.join("missing")))
+
+    empty = tmpdir.join("empty")
+    empty.write_binary(b"")
+    with pytest.raises(SnapshotError):
+        load_snapshot(WarmCache(), str(empty))
+
+    invalid = tmpdir.join("invalid")
+    invalid.write_binary(b"x" * 64)
+    with pytest.raises(SnapshotError):
+        load_snapshot(WarmCache(), str(invalid))
+
+
+def test_snapshot_path_per_process(monkeypatch):
+    monkeypatch.delenv("FOTC_SNAPSHOT_PATH", raising=False)
+    assert get_snapshot_path("worker-1") is None
+    monkeypatch.setenv("FOTC_SNAPSHOT_PATH", "/var/lib/fotc/snapshot")
+    assert get_snapshot_path() == "/var/lib/fotc/snapshot"
+    assert get_snapshot_path("worker-1") == "/var/lib/fotc/snapshot.worker-1"